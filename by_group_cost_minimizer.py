@@ -0,0 +1,166 @@
+#*******************************************************************************
+#Reversing the reversal
+#*******************************************************************************
+#Python routine for the by() option of coeff_reverser and mrs_reverser
+#Computes the hd regressions and reversal costs for every group in one pass
+#*******************************************************************************
+
+#=====================================
+#1. Set-up
+#=====================================
+
+#-------------------------------------
+#1.1 Import libraries
+#-------------------------------------
+
+import os
+os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
+
+import sys
+import numpy as np
+from sfi import Macro, Matrix
+
+sys.path.insert(0, Macro.getLocal('pydir'))
+from reversals_core import read_columns, ols_stats, read_settings, expand_stats, coefficient_tasks, ratio_tasks, multistart
+
+#-------------------------------------
+#1.2 Import settings
+#-------------------------------------
+
+mode = Macro.getLocal('by_mode')            # "coeff" or "mrs"
+settings, workers, n_starts = read_settings()
+robust = Macro.getLocal('se_name') == "robust"
+fweight = Macro.getLocal('wtype') == "fweight"
+use_pvalue = Macro.getLocal('pvalue') != ''
+
+scale_min = float(Macro.getLocal('scale_min'))
+scale_max = float(Macro.getLocal('scale_max'))
+levels = np.asarray(Matrix.get("_labels_depvar")).flatten()
+nlabs = len(levels)
+
+#=====================================
+#2. Import data from Stata
+#=====================================
+
+touse = Macro.getLocal('touse')
+n_touse = int(Macro.getLocal('n_touse'))
+
+# Regressors, in the order of e(b). Columns omitted in the original regression are not read.
+names = Macro.getLocal('names').split()
+x_cols = np.asarray(Macro.getLocal('x_cols').split(), dtype=int) - 1
+X = read_columns(Macro.getLocal('variables'), touse, n_touse)
+cons = names.index("_cons") if "_cons" in names else None
+cons = int(np.flatnonzero(x_cols == cons)[0]) if cons is not None else None
+
+y = read_columns(Macro.getLocal('depvar'), touse, n_touse)[:, 0]
+w = read_columns(Macro.getLocal('weightvar'), touse, n_touse)[:, 0]
+group = read_columns(Macro.getLocal('group'), touse, n_touse)[:, 0]
+by_vars = Macro.getLocal('by').split()
+keys = read_columns(by_vars, touse, n_touse)
+
+#-------------------------------------
+#2.1 Sort once by group, so every group is a contiguous block of rows
+#-------------------------------------
+
+order = np.argsort(group, kind='stable')
+X, y, w, group, keys = X[order], y[order], w[order], group[order], keys[order]
+del order
+starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+ends = np.r_[starts[1:], len(group)]
+n_groups = len(starts)
+
+#=====================================
+#3. Sufficient statistics and tasks for each group
+#=====================================
+
+k_all = len(names)
+explanatory = [i for i in range(k_all) if names[i] != "_cons"]
+if mode == "coeff":
+    revpoint = float(Macro.getLocal('revpoint'))
+    target_p = float(Macro.getLocal('critval')) if use_pvalue else None
+    columns = explanatory
+else:
+    denom = names.index(Macro.getLocal('denom'))
+    has_target = int(Macro.getLocal('has_target_ratio')) == 1
+    target_ratio = float(Macro.getLocal('target_ratio_value')) if has_target else None
+    rng = np.random.default_rng(0)
+    columns = [i for i in explanatory if i != denom]
+m = len(columns)
+
+# One row per group and one column per coefficient (coeff_reverser) or numerator (mrs_reverser)
+out = {}
+out_n = np.zeros((n_groups, 1))
+tasks = []          # (kind, group, column, arguments)
+
+for g in range(n_groups):
+    rows = slice(starts[g], ends[g])
+    # Coefficients of all of e(b); columns omitted overall or within the group stay at zero
+    stats = expand_stats(ols_stats(X[rows], y[rows], w[rows], levels, robust=robust and use_pvalue,
+                                   fweight=fweight, cons=cons), x_cols, k_all)
+    out_n[g, 0] = stats["n"]
+
+    if mode == "coeff":
+        group_out, group_tasks = coefficient_tasks(stats, columns, levels, scale_min, scale_max, revpoint, settings, target_p)
+    else:
+        group_out, group_tasks = ratio_tasks(stats, denom, columns, target_ratio, settings, rng)
+    for key, values in group_out.items():
+        out.setdefault(key, np.full((n_groups, m), np.nan))[g] = values
+    tasks += [(kind, g, j, args) for j, kind, args in group_tasks]
+
+del X, y, w
+
+#=====================================
+#4. Run all cost minimisations
+#=====================================
+
+out_cost = np.full((n_groups, m), np.nan)
+out_costp = np.full((n_groups, m), np.nan)
+out_approx = np.zeros((n_groups, m))       # 1 if a cost is the best found within budget()
+out_spread = np.full((n_groups, m), np.nan)  # spread of the cost across starts (Theil with starts() only)
+
+# Costs of tasks that did not finish because of a Break stay missing
+results, spreads = multistart([(kind, args) for kind, g, j, args in tasks], n_starts, workers)
+for (kind, g, j, args), result, spread in zip(tasks, results, spreads):
+    if result is None:
+        continue
+    fun, labels, approximate = result
+    if kind == "pvalue":
+        out_costp[g, j] = fun
+    else:
+        out_cost[g, j] = fun
+        out_spread[g, j] = spread
+    out_approx[g, j] = max(out_approx[g, j], approximate)
+interrupted = any(result is None for result in results)
+
+#=====================================
+#5. Return results to Stata
+#=====================================
+
+# Values of the by() variables for each group
+Matrix.store("_by_keys", keys[starts])
+Matrix.store("_by_n", out_n)
+Matrix.store("_by_cost", out_cost)
+Matrix.store("_by_approx", out_approx)
+if n_starts > 1:
+    Matrix.store("_by_spread", out_spread)
+Macro.setLocal("interrupted", str(int(interrupted)))
+
+if mode == "coeff":
+    Matrix.store("_by_b", out["b"])
+    Matrix.store("_by_minb", out["minb"])
+    Matrix.store("_by_maxb", out["maxb"])
+    if use_pvalue:
+        Matrix.store("_by_p", out["p"])
+        Matrix.store("_by_minp", out["minp"])
+        Matrix.store("_by_maxp", out["maxp"])
+        Matrix.store("_by_costp", out_costp)
+else:
+    # Unbounded ratios are stored as +/-999999999, as in mrs_reverser
+    Matrix.store("_by_ratio", out["ratio"])
+    Matrix.store("_by_minratio", np.nan_to_num(out["minratio"], nan=np.nan, neginf=-999999999))
+    Matrix.store("_by_maxratio", np.nan_to_num(out["maxratio"], nan=np.nan, posinf=999999999))
+
+if interrupted:
+    print(f"Reversal analysis interrupted: {sum(result is not None for result in results)} of {len(tasks)} cost minimisations completed")
+else:
+    print(f"Reversal analysis completed for {n_groups} groups")
@@ -0,0 +1,189 @@
+#*******************************************************************************
+#Reversing the reversal
+#*******************************************************************************
+#Python routine for the state() option of coeff_reverser
+#Folds new observations into the sufficient statistics saved by a previous run
+#and re-optimises every coefficient starting from the previously optimal labels
+#*******************************************************************************
+
+#=====================================
+#1. Set-up
+#=====================================
+
+#-------------------------------------
+#1.1 Import libraries
+#-------------------------------------
+
+import os
+os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
+
+import sys
+import numpy as np
+from sfi import Macro, Matrix
+
+sys.path.insert(0, Macro.getLocal('pydir'))
+from reversals_core import (read_columns, compress_rows, ols_sums, add_sums, ols_from_sums, chol_update, inverse_update, still_collinear,
+                            read_settings, expand_stats, coefficient_tasks, multistart)
+
+#-------------------------------------
+#1.2 Import settings
+#-------------------------------------
+
+settings, workers, n_starts = read_settings()
+revpoint = float(Macro.getLocal('revpoint'))
+wtype = Macro.getLocal('wtype')
+fweight = wtype == "fweight"
+use_pvalue = Macro.getLocal('pvalue') != ''
+target_p = float(Macro.getLocal('critval'))
+
+state_file = Macro.getLocal('state')          # always ends in .npz
+update = Macro.getLocal('update') != ''
+
+names = Macro.getLocal('names').split()
+x_cols = np.asarray(Macro.getLocal('x_cols').split(), dtype=int) - 1
+cons = int(np.flatnonzero(x_cols == names.index("_cons"))[0]) if "_cons" in names else None
+
+#-------------------------------------
+#1.3 Load the previous state
+#-------------------------------------
+
+if update:
+    previous = np.load(state_file)
+    if previous["names"].tolist() != names or previous["x_cols"].tolist() != x_cols.tolist():
+        raise ValueError("The regressors differ from those of the run saved in " + state_file)
+    # N is the sum of the weights with fweights but the number of observations otherwise
+    if "wtype" not in previous.files or str(previous["wtype"]) != wtype:
+        raise ValueError("The weight type differs from that of the run saved in " + state_file)
+    levels = previous["levels"]
+    scale_min, scale_max = float(previous["scale"][0]), float(previous["scale"][1])
+else:
+    levels = np.asarray(Matrix.get("_labels_depvar")).flatten()
+    scale_min = float(Macro.getLocal('scale_min'))
+    scale_max = float(Macro.getLocal('scale_max'))
+nlabs = len(levels)
+
+#=====================================
+#2. Sufficient statistics of the new observations
+#=====================================
+
+touse = Macro.getLocal('touse')
+n_touse = int(Macro.getLocal('n_touse'))
+
+X = read_columns(Macro.getLocal('variables'), touse, n_touse)
+y = read_columns(Macro.getLocal('depvar'), touse, n_touse)[:, 0]
+w = read_columns(Macro.getLocal('weightvar'), touse, n_touse)[:, 0]
+
+# The hd are defined by the labels of the saved run, so new labels cannot be added
+if not np.isin(y, levels).all():
+    raise ValueError("The dependent variable takes values that do not occur in the run saved in " + state_file)
+
+# Rows with identical regressors and outcome are collapsed into cells with summed weights
+X, y, w, w2, rows = compress_rows(X, y, w)
+sums = ols_sums(X, y, w, levels, fweight, rows)
+
+#=====================================
+#3. Combine with the previous state
+#=====================================
+
+if update:
+    previous_sums = {key: previous[key] for key in sums}
+    sums = add_sums(previous_sums, sums)
+
+    # Update the Cholesky factor of X'WX and its inverse with the (weighted) new
+    # rows or cells if that is cheaper than factorising again and the new rows keep
+    # the collinear columns collinear. The saved independent columns then still hold.
+    kept = previous["kept"]
+    if len(y) <= kept.sum() and still_collinear(previous["XtWX"], kept, previous["L"], X):
+        V = (X[:, kept] * np.sqrt(w)[:, np.newaxis]).T
+        stats = ols_from_sums(sums, cons, chol_update(previous["L"], V), kept, inverse_update(previous["A_inv"], V))
+    else:
+        stats = ols_from_sums(sums, cons)
+
+    labels_start = previous["labels"]
+    labels_start_p = previous["labels_p"]
+else:
+    stats = ols_from_sums(sums, cons)
+    labels_start = np.full((len(names), nlabs), np.nan)
+    labels_start_p = np.full((len(names), nlabs), np.nan)
+
+del X, y, w, w2
+
+#=====================================
+#4. Re-optimise every coefficient
+#=====================================
+
+#-------------------------------------
+#4.1 Coefficients of all of e(b) in the combined sample
+#-------------------------------------
+
+k_all = len(names)
+stats_p = expand_stats(stats, x_cols, k_all)
+explanatory = [i for i in range(k_all) if names[i] != "_cons"]
+m = len(explanatory)
+out_cost = np.full(m, np.nan)
+out_costp = np.full(m, np.nan)
+
+#-------------------------------------
+#4.2 Warm-started cost minimisations
+#-------------------------------------
+
+# Every coefficient starts from its previously optimal labels if there are any, otherwise from the original labels
+out, tasks = coefficient_tasks(stats_p, explanatory, levels, scale_min, scale_max, revpoint, settings,
+                               target_p if use_pvalue else None, labels_start, labels_start_p)
+results, spreads = multistart([(kind, args) for j, kind, args in tasks], n_starts, workers)
+
+# Tasks that did not finish because of a Break keep missing costs and the previously optimal labels
+out_approx = np.zeros(m)
+out_spread = np.full(m, np.nan)
+labels_new = np.array(labels_start)
+labels_new_p = np.array(labels_start_p)
+for (j, kind, args), result, spread in zip(tasks, results, spreads):
+    if result is None:
+        continue
+    fun, labels, approximate = result
+    if kind == "sign":
+        out_cost[j] = fun
+        out_spread[j] = spread
+        labels_new[explanatory[j]] = labels
+    else:
+        out_costp[j] = fun
+        labels_new_p[explanatory[j]] = labels
+    out_approx[j] = max(out_approx[j], approximate)
+interrupted = any(result is None for result in results)
+
+#=====================================
+#5. Save the new state
+#=====================================
+
+# Written to a temporary file first, so an interrupted run leaves the old state intact
+tmp_file = state_file[:-len(".npz")] + "_tmp.npz"
+np.savez(tmp_file, names=np.asarray(names), x_cols=x_cols, levels=levels,
+         scale=np.asarray([scale_min, scale_max]), wtype=np.asarray(wtype),
+         kept=stats["kept"], L=stats["L"], A_inv=stats["A_inv"],
+         labels=labels_new, labels_p=labels_new_p,
+         **{key: stats[key] for key in sums})
+os.replace(tmp_file, state_file)
+
+#=====================================
+#6. Return results to Stata
+#=====================================
+
+# Stored as row vectors, one column per explanatory variable
+Matrix.store("_state_b", out["b"][np.newaxis, :])
+Matrix.store("_state_minb", out["minb"][np.newaxis, :])
+Matrix.store("_state_maxb", out["maxb"][np.newaxis, :])
+Matrix.store("_state_cost", out_cost[np.newaxis, :])
+Matrix.store("_state_approx", out_approx[np.newaxis, :])
+if n_starts > 1:
+    Matrix.store("_state_spread", out_spread[np.newaxis, :])
+Macro.setLocal("interrupted", str(int(interrupted)))
+if use_pvalue:
+    Matrix.store("_state_p", out["p"][np.newaxis, :])
+    Matrix.store("_state_minp", out["minp"][np.newaxis, :])
+    Matrix.store("_state_maxp", out["maxp"][np.newaxis, :])
+    Matrix.store("_state_costp", out_costp[np.newaxis, :])
+Macro.setLocal("state_N", str(stats["n"]))
+
+if interrupted:
+    print(f"Reversal analysis interrupted: {sum(result is not None for result in results)} of {len(tasks)} cost minimisations completed")
+print(f"Reversal analysis saved to {state_file} (N = {stats['n']:.0f})")
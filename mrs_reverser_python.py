@@ -15,10 +15,14 @@
 import os
 os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
 
+import sys
 import numpy as np
 from sfi import Data, Macro, Matrix
 from scipy.optimize import minimize, LinearConstraint, NonlinearConstraint, BFGS
 
+sys.path.insert(0, Macro.getLocal('pydir'))
+from reversals_core import mrs_task, multistart
+
 #=====================================
 #2. Define cost function (same as other scripts)
 #=====================================
@@ -141,6 +145,17 @@ l_original = np.array(range(1, nlabs+1, 1))
 scale_min = np.amin(l_original)
 scale_max = np.amax(l_original)
 
+# Anytime settings: stop once the target cost is known to within gap() or relative to threshold(), or after budget() seconds
+gap = float(Macro.getLocal('gap'))
+threshold = float(Macro.getLocal('threshold'))
+budget = float(Macro.getLocal('budget'))
+anytime = gap > 0 or threshold >= 0 or budget > 0
+
+# Multi-start settings: the Theil index is minimised from starts() seeded starting labels, solved in parallel
+starts = int(Macro.getLocal('starts'))
+multistart_theil = use_theil and starts > 1
+workers = int(Macro.getLocal('workers'))
+
 #=====================================
 #4. Set up constraints
 #=====================================
@@ -222,9 +237,14 @@ original_ratios = []
 min_ratios = []
 max_ratios = []
 target_costs = []
+target_approx = []      # 1 if the target cost is the best found within budget()
+target_spread = []      # spread of the target costs across starts (multi-start only)
+interrupted = False     # after a Break, the remaining target costs are left missing
 
 for var_idx in range(num_vars):
     bdm_col = bdm_matrix[:, var_idx]
+    target_approx.append(0)
+    target_spread.append(np.nan)
     
     #-------------------------------------
     #6.1.1 Calculate original ratio
@@ -262,7 +282,30 @@ for var_idx in range(num_vars):
         
         # For reversible denominators, we still attempt the calculation 
         # but bounds checking is different (infinite bounds mean any ratio is theoretically achievable)
-        if denom_reversible or (min_ratio <= target_ratio <= max_ratio):
+        if interrupted:
+            target_costs.append(np.nan)
+        elif (anytime or multistart_theil) and (denom_reversible or (min_ratio <= target_ratio <= max_ratio)):
+            # The target ratio is linear in the labels, so it is solved with bounds or from seeded starts rather than from a random start
+            task = {"bdm": bdm_col, "bdn": bdn, "target": target_ratio,
+                    "l_start": l_original.astype(np.float64),
+                    "scale_min": float(scale_min), "scale_max": float(scale_max),
+                    "alpha": alpha_value, "theil": use_theil, "gap": gap,
+                    "threshold": threshold if threshold >= 0 else None,
+                    "budget": budget if budget > 0 else None}
+            try:
+                if multistart_theil:
+                    results, spreads = multistart([("mrs", task)], starts, workers)
+                    if results[0] is None:
+                        raise KeyboardInterrupt
+                    (fun, labels, approximate), target_spread[-1] = results[0], spreads[0]
+                else:
+                    fun, labels, approximate = mrs_task(task)
+            except KeyboardInterrupt:
+                interrupted = True
+                fun, approximate = np.nan, False
+            target_costs.append(fun)
+            target_approx[-1] = int(approximate)
+        elif denom_reversible or (min_ratio <= target_ratio <= max_ratio):
             # Define constraint for target ratio
             target_constraint = NonlinearConstraint(
                 lambda x: ratio_constraint_func(x, bdm_col, target_ratio), 
@@ -289,6 +332,9 @@ for var_idx in range(num_vars):
                     target_costs.append(result.fun)
                 else:
                     target_costs.append(np.nan)
+            except KeyboardInterrupt:
+                interrupted = True
+                target_costs.append(np.nan)
             except:
                 # Handle optimization failures gracefully
                 target_costs.append(np.nan)
@@ -317,11 +363,14 @@ for i in range(num_vars):
         Macro.setLocal(f"target_cost_{var_num}", str(target_costs[i]))
     else:
         Macro.setLocal(f"target_cost_{var_num}", ".")
+    Macro.setLocal(f"target_approx_{var_num}", str(target_approx[i]))
+    Macro.setLocal(f"target_spread_{var_num}", str(target_spread[i]) if not np.isnan(target_spread[i]) else ".")
 
 #-------------------------------------
 #7.2 Store summary information
 #-------------------------------------
 
 Macro.setLocal("num_variables", str(num_vars))
+Macro.setLocal("interrupted", str(int(interrupted)))
 
 print(f"MRS reversal analysis completed for {num_vars} variables")
\ No newline at end of file
@@ -0,0 +1,143 @@
+#*******************************************************************************
+#Reversing the reversal
+#*******************************************************************************
+#Python routine for the outcomes() option of coeff_reverser and mrs_reverser
+#Computes the hd regressions and reversal costs for several dependent variables
+#that share the regressors, weights and estimation sample, in one pass
+#*******************************************************************************
+
+#=====================================
+#1. Set-up
+#=====================================
+
+#-------------------------------------
+#1.1 Import libraries
+#-------------------------------------
+
+import os
+os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
+
+import sys
+import numpy as np
+from sfi import Macro, Matrix
+
+sys.path.insert(0, Macro.getLocal('pydir'))
+from reversals_core import (read_columns, ols_stats_outcomes, read_settings, expand_stats, coefficient_tasks,
+                            ratio_tasks, multistart)
+
+#-------------------------------------
+#1.2 Import settings
+#-------------------------------------
+
+mode = Macro.getLocal('outcome_mode')       # "coeff" or "mrs"
+settings, workers, n_starts = read_settings()
+robust = Macro.getLocal('se_name') == "robust"
+fweight = Macro.getLocal('wtype') == "fweight"
+use_pvalue = Macro.getLocal('pvalue') != ''
+
+# Labels and scale of every outcome
+outcomes = Macro.getLocal('outcomes').split()
+n_outcomes = len(outcomes)
+levels = [np.asarray(Matrix.get(f"_labels_outcome{o+1}")).flatten() for o in range(n_outcomes)]
+scales = [(float(Macro.getLocal(f'scale_min{o+1}')), float(Macro.getLocal(f'scale_max{o+1}'))) for o in range(n_outcomes)]
+
+# Columns of the tidy results matrix, in order
+results = Macro.getLocal('results').split()
+keep = Macro.getLocal('keep').split()
+
+#=====================================
+#2. Import data from Stata
+#=====================================
+
+touse = Macro.getLocal('touse')
+n_touse = int(Macro.getLocal('n_touse'))
+
+# Regressors, in the order of e(b). Columns omitted in the original regression are not read.
+names = Macro.getLocal('names').split()
+x_cols = np.asarray(Macro.getLocal('x_cols').split(), dtype=int) - 1
+X = read_columns(Macro.getLocal('variables'), touse, n_touse)
+cons = names.index("_cons") if "_cons" in names else None
+cons = int(np.flatnonzero(x_cols == cons)[0]) if cons is not None else None
+
+Y = read_columns(outcomes, touse, n_touse)
+w = read_columns(Macro.getLocal('weightvar'), touse, n_touse)[:, 0]
+
+#=====================================
+#3. Sufficient statistics and tasks for each outcome
+#=====================================
+
+# X'WX is factorised once; the hd of all outcomes are right-hand sides of that factor
+all_stats = ols_stats_outcomes(X, Y, w, levels, robust=robust and use_pvalue, fweight=fweight, cons=cons)
+del X, Y, w
+
+k_all = len(names)
+explanatory = [i for i in range(k_all) if names[i] != "_cons"]
+if mode == "coeff":
+    revpoint = float(Macro.getLocal('revpoint'))
+    target_p = float(Macro.getLocal('critval')) if use_pvalue else None
+else:
+    denom = names.index(Macro.getLocal('denom'))
+    explanatory = [i for i in explanatory if i != denom]
+    has_target = int(Macro.getLocal('has_target_ratio')) == 1
+    target_ratio = float(Macro.getLocal('target_ratio_value')) if has_target else None
+    rng = np.random.default_rng(0)
+if keep:
+    explanatory = [i for i in explanatory if names[i] in keep]
+m = len(explanatory)
+
+# One row per outcome and coefficient, one column per result
+out = {result: np.full((n_outcomes, m), np.nan) for result in results}
+if "approx" in out:
+    out["approx"][:] = 0
+
+tasks = []          # (kind, outcome, column, arguments)
+
+for o, stats in enumerate(all_stats):
+    # Coefficients of all of e(b); columns omitted in the original regression stay at zero
+    stats = expand_stats(stats, x_cols, k_all)
+    if mode == "coeff":
+        scale_min, scale_max = scales[o]
+        outcome_out, outcome_tasks = coefficient_tasks(stats, explanatory, levels[o], scale_min, scale_max, revpoint,
+                                                       settings, target_p)
+    else:
+        outcome_out, outcome_tasks = ratio_tasks(stats, denom, explanatory, target_ratio, settings, rng)
+    for key, values in outcome_out.items():
+        out[key][o] = values
+    tasks += [(kind, o, j, args) for j, kind, args in outcome_tasks]
+
+#=====================================
+#4. Run all cost minimisations
+#=====================================
+
+# Costs of tasks that did not finish because of a Break stay missing
+results_tasks, spreads = multistart([(kind, args) for kind, o, j, args in tasks], n_starts, workers)
+for (kind, o, j, args), result, spread in zip(tasks, results_tasks, spreads):
+    if result is None:
+        continue
+    fun, labels, approximate = result
+    if kind == "pvalue":
+        out["costp"][o, j] = fun
+    else:
+        out["cost"][o, j] = fun
+        if "spread" in out:
+            out["spread"][o, j] = spread
+    out["approx"][o, j] = max(out["approx"][o, j], approximate)
+interrupted = any(result is None for result in results_tasks)
+
+#=====================================
+#5. Return results to Stata
+#=====================================
+
+# Tidy matrix: one row per outcome and coefficient (outcomes in order, coefficients within
+# each), one column per result. Unbounded ratios are stored as +/-999999999, as in mrs_reverser.
+tidy = np.column_stack([out[result].reshape(-1) for result in results])
+tidy = np.nan_to_num(tidy, nan=np.nan, posinf=999999999, neginf=-999999999)
+Matrix.store("_outcomes_results", tidy)
+Macro.setLocal("outcomes_rows", " ".join(f"{outcomes[o]}:{names[i]}" for o in range(n_outcomes) for i in explanatory))
+Macro.setLocal("outcomes_N", str(all_stats[0]["n"]))
+Macro.setLocal("interrupted", str(int(interrupted)))
+
+if interrupted:
+    print(f"Reversal analysis interrupted: {sum(result is not None for result in results_tasks)} of {len(tasks)} cost minimisations completed")
+else:
+    print(f"Reversal analysis completed for {n_outcomes} outcomes")
@@ -16,11 +16,15 @@
 import os
 os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
 
+import sys
 import numpy as np
-from sfi import Data, Macro, Matrix
+from sfi import Macro, Matrix
 from scipy import stats
 from scipy.optimize import minimize, LinearConstraint, NonlinearConstraint, BFGS  
 
+sys.path.insert(0, Macro.getLocal('pydir'))
+from reversals_core import read_columns, compress_rows, hd_residuals, tracked_minimize, task_deadline
+
 #=====================================
 #2. Define cost function (from sign_reversal_cost_minimizer.py)
 #=====================================
@@ -109,30 +113,25 @@ def calculate_betas(bds, labels):
 #3.2. Define function to calculate variance-covariance matrix
 #-------------------------------------
 
-def calculate_variance_covariance(n, k, X, eds, se_type, labels, W, W_vec):
+def calculate_variance_covariance(n, k, X, eds, se_type, labels, W_vec, W2_vec, XtWX_inv):
     """Calculate variance-covariance matrix for different SE types"""
     
     # Calculate e_from_d (residuals)
-    for i in range(0,len(labels)-1):
-        if i>0:
-            j = i+1
-            e_from_d = e_from_d + (labels[i]-labels[j])*eds[:,i]
-        else:
-            e_from_d = (labels[0]-labels[1])*eds[:,0]
+    e_from_d = eds @ (labels[:-1] - labels[1:])
 
     # Basic standard errors (OLS)
     if se_type == 1:
-        scalar = ((e_from_d @ W @ e_from_d)/(n-k))  # Since W_vec.sum() = n.
-        varcov = scalar * np.linalg.inv(X.T @ W @ X)
+        scalar = ((W_vec @ e_from_d**2)/(n-k))  # Since W_vec.sum() = n.
+        varcov = scalar * XtWX_inv
 
     # Heteroskedasticity-robust standard errors
     elif se_type == 2:
-        e_sq = e_from_d ** 2
         finite_sample_correction = n / (n - k)
-        # Correct sandwich estimator: (X'WX)^(-1) * X'W * diag(e_sq) * W * X * (X'WX)^(-1)
-        XtWX_inv = np.linalg.inv(X.T @ W @ X)
-        # Create diagonal matrix from squared residuals weighted appropriately
-        middle_term = X.T @ W @ np.diag(e_sq) @ W @ X
+        # Sandwich estimator: (X'WX)^(-1) * X'W * diag(e_sq) * W * X * (X'WX)^(-1)
+        # X'W diag(e_sq) W X is formed from the rows of X scaled by w*e, never as an n x n matrix.
+        # W2_vec sums w^2 over the rows of each cell, so sqrt(W2_vec)*e gives the same sum.
+        Xwe = X * (np.sqrt(W2_vec) * e_from_d)[:, np.newaxis]
+        middle_term = Xwe.T @ Xwe
         varcov = finite_sample_correction * XtWX_inv @ middle_term @ XtWX_inv
 
     return np.diag(varcov)
@@ -141,11 +140,12 @@ def calculate_variance_covariance(n, k, X, eds, se_type, labels, W, W_vec):
 #3.3. Define function to calculate p-values
 #-------------------------------------
 
-def calculate_p_values(bds, labels_transformed, n, k, X, eds, se_type, df, W, W_vec):
+def calculate_p_values(bds, labels_transformed, n, k, X, eds, se_type, df, W_vec, W2_vec, XtWX_inv):
     """Calculate p-values for given labels transformation"""
     beta = calculate_betas(bds, labels_transformed)
-    varcov = calculate_variance_covariance(n, k, X, eds, se_type, labels_transformed, W, W_vec)
-    SEs = np.sqrt(varcov)
+    # Coefficients without a column in X (see section 4.2) get a missing SE
+    SEs = np.full(k, np.nan)
+    SEs[x_cols] = np.sqrt(calculate_variance_covariance(n, k, X, eds, se_type, labels_transformed, W_vec, W2_vec, XtWX_inv))
     t = beta/SEs
     p = 2 * stats.t.sf(abs(t), df)
     return p
@@ -171,30 +171,54 @@ if se_name == "robust":
 # Target p-value
 target_p = float(Macro.getLocal('critval'))
 
+# Cost threshold: a search stops at the first labels that reach the target at a cost below it (negative: no threshold)
+threshold = float(Macro.getLocal('threshold'))
+
+# Time budget per coefficient in seconds: the search returns the best labels found so far once it runs out (0: no limit)
+budget = float(Macro.getLocal('budget'))
+
 #-------------------------------------
 #4.2 Import X matrix and other data
 #-------------------------------------
 
-# Independent variables (X matrix)
+# Number of observations in the estimation sample (marked by touse)
+touse = Macro.getLocal('touse')
+n_touse = int(Macro.getLocal('n_touse'))
+
+# Independent variables (X matrix), read column by column into one float64 array
 variables = Macro.getLocal('variables')
-X = np.asarray(Data.get(variables))
+X = read_columns(variables, touse, n_touse)
 
-# Weight variable (always exists, normalized so sum = N)
-W_vec = np.asarray(Data.get("_weightvar")).flatten()
-W = np.diag(W_vec)
+# Position of each column of X among the coefficients in e(b)
+x_cols = np.asarray(Macro.getLocal('x_cols').split(), dtype=int) - 1
 
-# Residuals from d regressions (use _hd_residual_* pattern)
-eds_vars = []
-n_d_regressions = int(Macro.getLocal('nrows_d_result'))
-for i in range(1, n_d_regressions + 1):
-    eds_vars.append(f"_hd_residual_{i}")
-eds_names = " ".join(eds_vars)
-eds = np.asarray(Data.get(eds_names))
+# Weight variable (always exists), normalized so sum = N
+W_vec = read_columns(Macro.getLocal('weightvar'), touse, n_touse)[:, 0]
+W_vec = W_vec * (n / W_vec.sum())
+
+# Dependent variable and its labels
+y = read_columns(Macro.getLocal('depvar'), touse, n_touse)[:, 0]
+levels = np.asarray(Matrix.get("_labels_depvar")).flatten()
 
 # Coefficients from d regressions
 bds = np.asarray(Matrix.get("_bds"))
 bds = bds.T
 
+# Rows with identical regressors and outcome have identical residuals, so they are
+# collapsed into cells with summed weights (W2_vec sums the squared weights for HC1).
+# With clustered standard errors, rows of different clusters are never collapsed.
+cluster = Macro.getLocal('cluster')
+cluster = read_columns(cluster, touse, n_touse) if cluster else None
+X, y, W_vec, W2_vec, rows = compress_rows(X, y, W_vec, cluster)
+del cluster
+
+# Residuals from d regressions, computed from the threshold dummies of y
+eds = hd_residuals(X, y, levels, bds[x_cols, :])
+del y
+
+# (X'WX)^(-1) does not depend on the labels, so it is only computed once
+XtWX_inv = np.linalg.inv(X.T @ (W_vec[:, np.newaxis] * X))
+
 # Get actual dimensions from the data
 # Before transpose: bds is (n_d_regressions x k)  
 # After transpose: bds is (k x n_d_regressions)
@@ -256,12 +280,12 @@ boundary_constraint = LinearConstraint([tmp1,tmp2], [scale_min,scale_max], [scal
 
 # For the lower bound (minimize p-value)
 def p_one_arg_min(labels_transformed, coeff_idx):   
-    p = calculate_p_values(bds, labels_transformed, n, k, X, eds, se_type, df, W, W_vec)
+    p = calculate_p_values(bds, labels_transformed, n, k, X, eds, se_type, df, W_vec, W2_vec, XtWX_inv)
     return p[0][coeff_idx]
 
 # For the upper bound (maximize p-value)
 def p_one_arg_max(labels_transformed, coeff_idx):   
-    p = calculate_p_values(bds, labels_transformed, n, k, X, eds, se_type, df, W, W_vec)
+    p = calculate_p_values(bds, labels_transformed, n, k, X, eds, se_type, df, W_vec, W2_vec, XtWX_inv)
     return -p[0][coeff_idx]
 
 #-------------------------------------
@@ -275,7 +299,11 @@ def minimize_wrapper_min(target_p_val, coeff_idx):
         return p_one_arg_min(labels_transformed, coeff_idx)
     
     ratio_constraint_nonlinear = NonlinearConstraint(p_constraint, -np.inf, target_p_val, jac='2-point', hess=BFGS()) 
-    result = minimize(cost, l_original, constraints=[monotonicity_constraint, ratio_constraint_nonlinear, boundary_constraint], tol=1e-8, options = {'maxiter': 10000, 'disp': False})
+    constraints = [monotonicity_constraint, ratio_constraint_nonlinear, boundary_constraint]
+    if threshold >= 0 or budget > 0:
+        return tracked_minimize(cost, l_original, (), constraints, threshold=threshold if threshold >= 0 else None,
+                                deadline=task_deadline({"budget": budget}), tol=1e-8, options = {'maxiter': 10000, 'disp': False})
+    result = minimize(cost, l_original, constraints=constraints, tol=1e-8, options = {'maxiter': 10000, 'disp': False})
     return result
 
 def minimize_wrapper_max(target_p_val, coeff_idx):
@@ -285,7 +313,11 @@ def minimize_wrapper_max(target_p_val, coeff_idx):
         return p_one_arg_min(labels_transformed, coeff_idx)
     
     ratio_constraint_nonlinear = NonlinearConstraint(p_constraint, target_p_val, np.inf, jac='2-point', hess=BFGS()) 
-    result = minimize(cost, l_original, constraints=[monotonicity_constraint, ratio_constraint_nonlinear, boundary_constraint], tol=1e-8, options = {'maxiter': 10000, 'disp': False})
+    constraints = [monotonicity_constraint, ratio_constraint_nonlinear, boundary_constraint]
+    if threshold >= 0 or budget > 0:
+        return tracked_minimize(cost, l_original, (), constraints, threshold=threshold if threshold >= 0 else None,
+                                deadline=task_deadline({"budget": budget}), tol=1e-8, options = {'maxiter': 10000, 'disp': False})
+    result = minimize(cost, l_original, constraints=constraints, tol=1e-8, options = {'maxiter': 10000, 'disp': False})
     return result
 
 #=====================================
@@ -301,7 +333,7 @@ lower_final = min_pval_matrix.flatten()
 upper_final = max_pval_matrix.flatten()
 
 # Get original p-values for cost calculation
-test_p = calculate_p_values(bds, l_original, n, k, X, eds, se_type, df, W, W_vec)
+test_p = calculate_p_values(bds, l_original, n, k, X, eds, se_type, df, W_vec, W2_vec, XtWX_inv)
 actual_k = len(test_p[0])  # Use actual number of p-values returned
 
 #=====================================
@@ -312,26 +344,35 @@ actual_k = len(test_p[0])  # Use actual number of p-values returned
 orig_p = test_p
 
 # Compute costs for each coefficient - use actual number of coefficients
-costs = [0] * actual_k
-for h in range(0, actual_k):
-    # Check if p-value is within bounds
-    if lower_final[h] <= target_p <= upper_final[h]:
-        # Determine which optimizer to use based on original p-value
-        if orig_p[0][h] > target_p:
-            # Need to decrease p-value
-            result = minimize_wrapper_min(target_p, h)
+# Costs that are the best found within budget() are flagged in approx. After a Break, the remaining costs stay missing.
+costs = [np.nan] * actual_k
+approx = [0] * actual_k
+interrupted = 0
+try:
+    for h in range(0, actual_k):
+        # Check if p-value is within bounds
+        if lower_final[h] <= target_p <= upper_final[h]:
+            # Determine which optimizer to use based on original p-value
+            if orig_p[0][h] > target_p:
+                # Need to decrease p-value
+                result = minimize_wrapper_min(target_p, h)
+            else:
+                # Need to increase p-value
+                result = minimize_wrapper_max(target_p, h)
+                
+            costs[h] = result.fun
+            approx[h] = int(getattr(result, "approximate", False))
         else:
-            # Need to increase p-value
-            result = minimize_wrapper_max(target_p, h)
-            
-        costs[h] = result.fun
-    else:
-        # If target p-value is outside bounds, set to missing
-        costs[h] = np.nan
+            # If target p-value is outside bounds, set to missing
+            costs[h] = np.nan
+except KeyboardInterrupt:
+    interrupted = 1
 
 #=====================================
 #9. Store results back to Stata
 #=====================================
 
 Matrix.store("_orig", orig_p[0])
-Matrix.store("_costs", costs)
\ No newline at end of file
+Matrix.store("_costs", costs)
+Matrix.store("_approx", approx)
+Macro.setLocal("interrupted_p", str(interrupted))
\ No newline at end of file
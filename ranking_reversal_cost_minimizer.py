@@ -0,0 +1,86 @@
+#*******************************************************************************
+#Reversing the reversal
+#*******************************************************************************
+#Python routine for the rank() option of coeff_reverser
+#Minimum cost to reverse the ordering of every pair of a set of coefficients
+#*******************************************************************************
+
+#=====================================
+#1. Set-up
+#=====================================
+
+import os
+os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
+
+import sys
+import numpy as np
+from sfi import Macro, Matrix
+
+sys.path.insert(0, Macro.getLocal('pydir'))
+from reversals_core import reversal_array, is_reversible, read_settings, multistart
+
+#=====================================
+#2. Import from Stata
+#=====================================
+
+# Coefficients from the hd regressions for the ranked coefficients (one column each)
+bds = np.asarray(Matrix.get("_rank_bds"))
+m = bds.shape[1]
+
+# Original labels and scale
+l_original = np.asarray(Matrix.get("_labels_depvar")).flatten()
+scale_min = float(Macro.getLocal('scale_min'))
+scale_max = float(Macro.getLocal('scale_max'))
+
+settings, workers, n_starts = read_settings()
+
+#=====================================
+#3. Screen all pairs
+#=====================================
+
+# The difference of two coefficients is itself linear in the labels, with hd
+# coefficients equal to the difference of their hd coefficients. Its ordering
+# can only be reversed if 0 lies within the bounds of the difference.
+
+costs = np.full((m, m), np.nan)
+pairs = []
+tasks = []
+for a in range(m):
+    for b in range(a+1, m):
+        bd = bds[:, a] - bds[:, b]
+        if not is_reversible(bd, 0, scale_min, scale_max):
+            continue
+        diff = reversal_array(bd) @ l_original
+        pairs.append((a, b))
+        tasks.append(("sign", dict(settings, bd=bd, sign=np.sign(diff), revpoint=0.0,
+                                   l_start=l_original, scale_min=scale_min, scale_max=scale_max)))
+
+#=====================================
+#4. Solve the remaining pairs together
+#=====================================
+
+# Pairs that did not finish because of a Break stay missing
+approx = np.zeros((m, m))
+spread = np.full((m, m), np.nan)
+results, spreads = multistart(tasks, n_starts, workers)
+for (a, b), result, pair_spread in zip(pairs, results, spreads):
+    if result is None:
+        continue
+    fun, labels, approximate = result
+    costs[a, b] = fun
+    costs[b, a] = fun
+    approx[a, b] = approx[b, a] = approximate
+    spread[a, b] = spread[b, a] = pair_spread
+interrupted = any(result is None for result in results)
+
+#=====================================
+#5. Return results to Stata
+#=====================================
+
+Matrix.store("_rank_cost", costs)
+Matrix.store("_rank_approx", approx)
+if n_starts > 1:
+    Matrix.store("_rank_spread", spread)
+Macro.setLocal("rank_interrupted", str(int(interrupted)))
+
+print(f"Ranking reversal analysis completed: {len(pairs)} of {m*(m-1)//2} pairs reversible")
@@ -0,0 +1,1064 @@
+#*******************************************************************************
+#Reversing the reversal
+#*******************************************************************************
+#Shared Python routines imported by the cost minimisation scripts
+#*******************************************************************************
+
+#=====================================
+#1. Set-up
+#=====================================
+
+import os
+os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
+
+import sys
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sfi import Data, Macro
+from scipy.stats import t as t_dist, qmc
+from scipy.linalg import cho_solve
+from scipy.optimize import minimize, LinearConstraint, NonlinearConstraint, BFGS, OptimizeResult
+
+#=====================================
+#2. Transfer data from Stata
+#=====================================
+
+#-------------------------------------
+#2.1 Read variables into a preallocated array
+#-------------------------------------
+
+# Number of observations requested from Stata in one go. Bounds the size of the
+# intermediate Python list that sfi returns.
+CHUNK_SIZE = 1000000
+
+def read_columns(varnames, selectvar, n, chunk=CHUNK_SIZE):
+    """Read Stata variables into a contiguous (n x p) float64 array.
+
+    Variables are read one at a time and in chunks of observations, so that only
+    one column chunk ever exists as a Python list. Only observations for which
+    selectvar is nonzero are read. The name _cons gives a column of ones.
+    """
+    if isinstance(varnames, str):
+        varnames = varnames.split()
+    out = np.empty((n, len(varnames)), dtype=np.float64, order='F')
+    nobs = Data.getObsTotal()
+    for j, var in enumerate(varnames):
+        if var == "_cons":
+            out[:, j] = 1.0
+            continue
+        pos = 0
+        for start in range(0, nobs, chunk):
+            vals = Data.get(var, obs=range(start, min(start + chunk, nobs)), selectvar=selectvar)
+            m = len(vals)
+            if m == 0:
+                continue
+            out[pos:pos+m, j] = np.asarray(vals, dtype=np.float64).reshape(-1)
+            pos += m
+        if pos != n:
+            raise ValueError(f"expected {n} observations for {var}, read {pos}")
+    return out
+
+#-------------------------------------
+#2.2 Residuals of the hd regressions
+#-------------------------------------
+
+def hd_residuals(X, y, levels, bds):
+    """Residuals of the regressions of hd on X, without forming the dummies.
+
+    bds is (k x J) with one column per threshold; levels are the sorted labels
+    of the dependent variable. Column i of the result is 1[y <= levels[i]] - X bds[:,i].
+    """
+    eds = X @ -bds
+    for i in range(bds.shape[1]):
+        eds[:, i] += (y <= levels[i])
+    return eds
+
+#-------------------------------------
+#2.3 Rows with identical regressors and outcome
+#-------------------------------------
+
+def compress_rows(X, y, w, key=None, sample=10000, seed=0):
+    """Collapse rows with identical (X, y) into cells with summed weights.
+
+    Returns (X, y, w, w2, rows): one row per cell, the sums of w and of w^2
+    over its rows, and its number of rows. Any sum of w*f(x, y) or w^2*f(x, y)
+    over rows equals the sum over cells, so OLS and HC1 statistics are
+    unchanged. If fewer than half of the rows would be saved, the rows are
+    returned as they are, with rows=None. With more rows than sample, a sample
+    of rows is checked first so that e.g. continuous regressors skip the full
+    pass. y may hold several outcomes as columns, in which case cells are rows
+    with identical X and outcomes. key may give further columns that the rows
+    of a cell must share but that are not returned, e.g. the cluster of every
+    row, so that no cell spans two clusters.
+    """
+    n = len(y)
+    data = np.column_stack([X, y] if key is None else [X, y, key])
+    if n > sample:
+        # n/2 cells show the most distinct rows in a sample if they hold two rows
+        # each, so more distinct rows than that expectation mean more than n/2 cells
+        idx = np.random.default_rng(seed).choice(n, sample, replace=False)
+        max_distinct = n/2 * (1 - (n-sample)*(n-sample-1) / (n*(n-1)))
+        if len(np.unique(data[idx], axis=0)) > max_distinct:
+            return X, y, w, w**2, None
+
+    # Code every row by its combination of column values, one column at a time.
+    # Codes are renumbered 0, 1, ... whenever the next column could overflow them.
+    code = np.zeros(n, dtype=np.int64)
+    n_codes = 1
+    for column in data.T:
+        values, column_code = np.unique(column, return_inverse=True)
+        if n_codes*len(values) >= 2**62:
+            codes, code = np.unique(code, return_inverse=True)
+            n_codes = len(codes)
+        code = code*len(values) + column_code.reshape(-1)
+        n_codes *= len(values)
+    codes, first, inverse, rows = np.unique(code, return_index=True, return_inverse=True, return_counts=True)
+    if len(codes) > n/2:
+        return X, y, w, w**2, None
+    inverse = inverse.reshape(-1)
+    w_cells = np.bincount(inverse, weights=w, minlength=len(codes))
+    w2_cells = np.bincount(inverse, weights=w**2, minlength=len(codes))
+    return np.asfortranarray(X[first]), y[first], w_cells, w2_cells, rows.astype(np.float64)
+
+#=====================================
+#3. Cost function
+#=====================================
+
+def cost(l, alpha_value, use_theil):
+    """Cost of the labels l: (var/maxvar)^(1/alpha) or the normalized Theil index"""
+    K = len(l)
+    dl = np.diff(l)
+    maxdl = l[K-1] - l[0]
+    N = K - 1
+    exponent = 1/alpha_value
+
+    if use_theil:
+        # Theil T index of the normalized differences (which sum to 1, so the mean is 1/N)
+        ratio = dl / maxdl * N
+        ratio = ratio[ratio > 0]
+        theil = np.sum(ratio * np.log(ratio)) / N
+        return (theil / np.log(N))**exponent
+
+    maxvar = (1/N - 1/N**2)*maxdl**2
+    var = np.mean((dl - maxdl/N)**2)
+    return (var/maxvar)**exponent
+
+#=====================================
+#4. Constraints
+#=====================================
+
+def label_constraints(nlabs, scale_min, scale_max):
+    """Labels are weakly increasing and start and end at scale_min and scale_max"""
+    monotone_array = np.eye(nlabs-1, nlabs) - np.eye(nlabs-1, nlabs, 1)
+    monotonicity_constraint = LinearConstraint(monotone_array, -np.inf, 0)
+
+    boundary_array = np.zeros((2, nlabs))
+    boundary_array[0, 0] = 1
+    boundary_array[1, nlabs-1] = 1
+    boundary_constraint = LinearConstraint(boundary_array, [scale_min, scale_max], [scale_min, scale_max])
+
+    return monotonicity_constraint, boundary_constraint
+
+def reversal_array(bd):
+    """Vector a such that the coefficient implied by labels l is a @ l"""
+    bd = np.asarray(bd, dtype=np.float64)
+    return np.append(bd, 0) - np.insert(bd, 0, 0)
+
+def is_reversible(bd, revpoint, scale_min, scale_max):
+    """Whether revpoint lies within the bounds of the coefficient across hd transformations"""
+    width = scale_max - scale_min
+    return -width*np.max(bd) <= revpoint <= -width*np.min(bd)
+
+#=====================================
+#5. Sufficient statistics of the hd regressions
+#=====================================
+
+#-------------------------------------
+#5.1 Weighted OLS of every hd on X
+#-------------------------------------
+
+def independent_columns(XtWX, first=None, tol=1e-10):
+    """Columns of X that are not collinear with columns earlier in the order.
+
+    Like regress, the column `first` (usually the constant) is considered
+    before all others and so is never the one that is dropped.
+    """
+    k = XtWX.shape[0]
+    order = list(range(k))
+    if first is not None:
+        order.remove(first)
+        order.insert(0, first)
+    kept = []
+    for c in order:
+        if XtWX[c, c] <= 0:
+            continue
+        if kept:
+            G = XtWX[np.ix_(kept, kept)]
+            g = XtWX[kept, c]
+            resid = XtWX[c, c] - g @ np.linalg.solve(G, g)
+        else:
+            resid = XtWX[c, c]
+        if resid > tol*XtWX[c, c]:
+            kept.append(c)
+    mask = np.zeros(k, dtype=bool)
+    mask[kept] = True
+    return mask
+
+def ols_sums(X, y, w, levels, fweight=False, rows=None, XtWX=None, Xw=None):
+    """Additive sufficient statistics of the weighted regressions of hd on X.
+
+    The hd (1[y <= levels[i]] for all but the last level) are never formed:
+    X'WD and D'WD are cumulative sums of per-level totals. All entries are
+    sums over rows, so the sums of two samples add up to those of their union.
+    rows gives the number of rows in each row of X if it holds the cells of
+    compress_rows(). XtWX and Xw (X times w by row) may be passed if they are
+    already known, e.g. for several outcomes with the same X.
+    """
+    K = len(levels)
+    J = K - 1
+    yi = np.searchsorted(levels, y)
+
+    # Per-level totals of w*x and of w, then cumulated over levels
+    if Xw is None:
+        Xw = X * w[:, np.newaxis]
+    if XtWX is None:
+        XtWX = X.T @ Xw
+    level_sums = np.empty((X.shape[1], K))
+    for c in range(X.shape[1]):
+        level_sums[c] = np.bincount(yi, weights=Xw[:, c], minlength=K)
+    XtWD = np.cumsum(level_sums, axis=1)[:, :J]
+    cum_w = np.cumsum(np.bincount(yi, weights=w, minlength=K))[:J]
+    DtWD = cum_w[np.minimum.outer(np.arange(J), np.arange(J))]
+
+    if fweight:
+        n = w.sum()
+    else:
+        n = float(len(y)) if rows is None else rows.sum()
+    return {"n": n, "XtWX": XtWX, "XtWD": XtWD, "DtWD": DtWD}
+
+def add_sums(a, b):
+    """Sufficient statistics of the union of two samples"""
+    return {key: a[key] + b[key] for key in a}
+
+def ols_from_sums(sums, cons=None, chol=None, kept=None, A_inv=None):
+    """hd coefficients and residual Gram matrix from the sufficient statistics.
+
+    chol may give the lower Cholesky factor of X'WX restricted to the
+    independent columns kept, and A_inv its inverse, e.g. after updating
+    both with chol_update() and inverse_update(). The collinear columns and
+    the inverse are then not found again.
+    """
+    XtWX, XtWD, DtWD = sums["XtWX"], sums["XtWD"], sums["DtWD"]
+    J = XtWD.shape[1]
+
+    # Coefficients, with collinear columns omitted as regress would
+    kept = independent_columns(XtWX, first=cons) if kept is None else kept
+    L = np.linalg.cholesky(XtWX[np.ix_(kept, kept)]) if chol is None else chol
+    A_inv = cho_solve((L, True), np.eye(L.shape[0])) if A_inv is None else A_inv
+    B = np.zeros((XtWX.shape[0], J))
+    B[kept] = cho_solve((L, True), XtWD[kept])
+
+    # Weighted Gram matrix of the hd residuals: E'WE = D'WD - D'WX B
+    EtWE = DtWD - XtWD[kept].T @ B[kept]
+
+    return dict(sums, k=int(kept.sum()), kept=kept, B=B, L=L, A_inv=A_inv, EtWE=EtWE, robust=False)
+
+def chol_update(L, V):
+    """Lower Cholesky factor of L L' + V V', by one rank-1 update per column of V"""
+    L = L.copy()
+    p = L.shape[0]
+    for v in np.array(V, dtype=np.float64, ndmin=2).T:
+        v = v.copy()
+        for i in range(p):
+            r = np.hypot(L[i, i], v[i])
+            c = r / L[i, i]
+            s = v[i] / L[i, i]
+            L[i, i] = r
+            L[i+1:, i] = (L[i+1:, i] + s*v[i+1:]) / c
+            v[i+1:] = c*v[i+1:] - s*L[i+1:, i]
+    return L
+
+def inverse_update(A_inv, V):
+    """(A + V V')^-1 from A^-1, by the Woodbury identity"""
+    AV = A_inv @ V
+    return A_inv - AV @ np.linalg.solve(np.eye(V.shape[1]) + V.T @ AV, AV.T)
+
+def still_collinear(XtWX, kept, L, X, tol=1e-10):
+    """Whether the rows X keep the columns dropped from XtWX collinear with the kept ones.
+
+    L is the Cholesky factor of XtWX restricted to the kept columns. If the
+    rows satisfy the linear relations that made the other columns collinear,
+    X'WX with these rows added has the same independent columns.
+    """
+    dropped = ~kept
+    if not dropped.any():
+        return True
+    coef = cho_solve((L, True), XtWX[np.ix_(kept, dropped)])
+    resid = X[:, dropped] - X[:, kept] @ coef
+    return bool(np.all(np.abs(resid) <= tol*max(1.0, np.abs(X).max())))
+
+def ols_stats(X, y, w, levels, robust=False, fweight=False, cons=None):
+    """Sufficient statistics of the weighted regressions of hd on X.
+
+    Returns a dict with the hd coefficients B (k x J, zero for collinear
+    columns), the Gram matrix of the hd residuals, and (if robust) the
+    terms needed for the HC1 variance of any combination of the hd. Rows
+    with identical (X, y) are collapsed with compress_rows() first.
+    """
+    X, y, w, w2, rows = compress_rows(X, y, w)
+    stats = ols_from_sums(ols_sums(X, y, w, levels, fweight, rows), cons)
+    stats["robust"] = robust
+    if robust:
+        stats["M"] = hc1_terms(X, y, w2, levels, stats)
+    return stats
+
+def hc1_terms(X, y, w2, levels, stats):
+    """Terms M[j,k] of the HC1 middle matrix of the hd regressions.
+
+    X'W diag(e^2) W X with e = E g expands to sum_jk g_j g_k M[j,k]. w2 holds
+    the squared weights (summed over the rows of each cell of compress_rows()).
+    """
+    kept, B = stats["kept"], stats["B"]
+    J = B.shape[1]
+    Xk = X[:, kept]
+    E = hd_residuals(Xk, y, levels, B[kept])
+    kk = Xk.shape[1]
+    M = np.empty((J, J, kk, kk))
+    for j in range(J):
+        for h in range(j, J):
+            M[j, h] = Xk.T @ (Xk * (w2 * E[:, j] * E[:, h])[:, np.newaxis])
+            M[h, j] = M[j, h]
+    return M
+
+def ols_stats_outcomes(X, Y, w, levels, robust=False, fweight=False, cons=None):
+    """Sufficient statistics of the hd regressions of several outcomes on one X.
+
+    Y holds one outcome per column and levels the labels of each. X'WX is
+    formed and factorised once, and the hd of all outcomes are solved together
+    as right-hand sides of that factor. Returns one dict per outcome, as
+    ols_stats() would for that outcome.
+    """
+    X, Y, w, w2, rows = compress_rows(X, Y, w)
+    Xw = X * w[:, np.newaxis]
+    XtWX = X.T @ Xw
+    sums = [ols_sums(X, Y[:, o], w, levels[o], fweight, rows, XtWX, Xw) for o in range(Y.shape[1])]
+
+    kept = independent_columns(XtWX, first=cons)
+    L = np.linalg.cholesky(XtWX[np.ix_(kept, kept)])
+    A_inv = cho_solve((L, True), np.eye(L.shape[0]))
+    B_all = np.zeros((XtWX.shape[0], sum(s["XtWD"].shape[1] for s in sums)))
+    B_all[kept] = cho_solve((L, True), np.hstack([s["XtWD"][kept] for s in sums]))
+
+    all_stats = []
+    first = 0
+    for o, s in enumerate(sums):
+        B = B_all[:, first:first + s["XtWD"].shape[1]]
+        first += B.shape[1]
+        EtWE = s["DtWD"] - s["XtWD"][kept].T @ B[kept]
+        stats = dict(s, k=int(kept.sum()), kept=kept, B=B, L=L, A_inv=A_inv, EtWE=EtWE, robust=robust)
+        if robust:
+            stats["M"] = hc1_terms(X, Y[:, o], w2, levels[o], stats)
+        all_stats.append(stats)
+    return all_stats
+
+#-------------------------------------
+#5.2 Coefficients and p-values for given labels
+#-------------------------------------
+
+def label_gaps(labels):
+    """Weights on the hd coefficients implied by the labels (l_i - l_{i+1})"""
+    labels = np.asarray(labels, dtype=np.float64)
+    return labels[:-1] - labels[1:]
+
+def pvalues_from_gaps(stats, g):
+    """p-values of all coefficients for the combination g of the hd"""
+    n, k = stats["n"], stats["k"]
+    kept = stats["kept"]
+    A_inv = stats["A_inv"]
+    beta = stats["B"] @ g
+
+    # No residual degrees of freedom (e.g. a group with as many rows as regressors)
+    if n <= k:
+        return np.full(len(beta), np.nan)
+
+    if stats["robust"]:
+        middle_term = np.einsum('j,h,jhab->ab', g, g, stats["M"])
+        varcov = (n / (n - k)) * A_inv @ middle_term @ A_inv
+    else:
+        varcov = (g @ stats["EtWE"] @ g / (n - k)) * A_inv
+
+    SEs = np.full(len(beta), np.nan)
+    SEs[kept] = np.sqrt(np.diag(varcov))
+    return 2 * t_dist.sf(np.abs(beta / SEs), n - k)
+
+def hd_pvalues(stats):
+    """p-values from the regressions of each hd (J x k)"""
+    J = stats["B"].shape[1]
+    return np.vstack([pvalues_from_gaps(stats, np.eye(J)[j]) for j in range(J)])
+
+#=====================================
+#6. Bounds on the minimum cost
+#=====================================
+
+# With l = scale_min + cumsum(dl), every constraint a @ l that is linear in the
+# labels is linear in the gaps dl, which lie on the simplex dl >= 0, sum(dl) = R.
+# The variance of dl is (dl - R/N)'(dl - R/N)/N, so minimising the variance cost
+# subject to such a constraint is a projection onto the simplex cut by one
+# hyperplane, with a single Lagrange multiplier.
+
+#-------------------------------------
+#6.1 Linear constraints on the gaps between labels
+#-------------------------------------
+
+def gap_constraint(a, lo, hi, scale_min):
+    """Write lo <= a @ l as lo_q <= q @ dl, returning (q, lo_q, hi_q)"""
+    a = np.asarray(a, dtype=np.float64)
+    q = np.cumsum(a[::-1])[::-1][1:]
+    shift = scale_min*np.sum(a)
+    return q, lo - shift, hi - shift
+
+def labels_from_gaps(dl, scale_min):
+    """Labels starting at scale_min with gaps dl"""
+    return scale_min + np.r_[0, np.cumsum(dl)]
+
+def project_simplex(v, total):
+    """Euclidean projection of v onto {x >= 0, sum(x) = total}"""
+    u = np.sort(v)[::-1]
+    excess = np.cumsum(u) - total
+    rho = np.flatnonzero(u - excess/np.arange(1, len(v)+1) > 0)[-1]
+    return np.maximum(v - excess[rho]/(rho+1), 0)
+
+def variance_cost(var, N, R, alpha_value, use_theil):
+    """Cost of labels whose gaps have variance var (for the Theil index, a lower bound)"""
+    if use_theil:
+        # r*log(r) - r + 1 >= (r-1)^2/(2N) for the normalised gaps r = dl*N/R <= N
+        return (min(N*var/(2*R**2), np.log(N)) / np.log(N))**(1/alpha_value)
+    maxvar = (1/N - 1/N**2)*R**2
+    return (var/maxvar)**(1/alpha_value)
+
+def bounds_decided(lower, upper, gap, threshold):
+    """Whether the bounds are within gap or on the same side of threshold"""
+    if upper - lower <= gap:
+        return True
+    return threshold is not None and (upper <= threshold or lower > threshold)
+
+#-------------------------------------
+#6.2 Closed-form screening bounds
+#-------------------------------------
+
+def screening_bounds(q, lo, hi, R, scale_min, alpha_value, use_theil):
+    """Lower and upper bound on the minimum cost subject to lo <= q @ dl <= hi, without optimising.
+
+    The lower bound drops dl >= 0, which leaves the distance from equal gaps to
+    a hyperplane. The upper bound moves from equal gaps towards the single-gap
+    labels (the hd transformations) that reach the constraint first. Returns
+    (lower, upper, labels attaining upper), or None if the constraint cannot be met.
+    """
+    N = len(q)
+    u = np.full(N, R/N)
+    v0 = q @ u
+    if lo <= v0 <= hi:
+        return 0.0, 0.0, labels_from_gaps(u, scale_min)
+    target = hi if v0 > hi else lo
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (v0 - target)/(v0 - R*q)
+    t[~np.isfinite(t) | (t < 0) | (t > 1)] = np.inf
+    if np.isinf(t).all():
+        return None
+    j = np.argmin(t)
+    dl = (1 - t[j])*u
+    dl[j] += t[j]*R
+    labels = labels_from_gaps(dl, scale_min)
+
+    q_centred = q - np.mean(q)
+    var_lower = (v0 - target)**2/(q_centred @ q_centred)/N
+    return variance_cost(var_lower, N, R, alpha_value, use_theil), cost(labels, alpha_value, use_theil), labels
+
+#-------------------------------------
+#6.3 Anytime minimisation
+#-------------------------------------
+
+def anytime_minimum(q, lo, hi, R, scale_min, alpha_value, use_theil, gap=0.0, threshold=None, deadline=None,
+                    maxiter=200):
+    """Minimum cost subject to lo <= q @ dl <= hi, stopped as soon as bounds_decided().
+
+    Bisects on the multiplier of the constraint. Every multiplier gives a lower
+    bound (the Lagrangian dual of the variance problem), and every feasible gap
+    vector found on the way gives an upper bound (the best labels so far). For
+    the variance cost the bounds meet at the minimum; for the Theil index the
+    lower bound stays loose. The search also stops once time.monotonic() passes
+    deadline. Returns (lower, upper, labels) or None.
+    """
+    screen = screening_bounds(q, lo, hi, R, scale_min, alpha_value, use_theil)
+    if screen is None:
+        return None
+    lower, upper, labels = screen
+    if bounds_decided(lower, upper, gap, threshold):
+        return lower, upper, labels
+
+    N = len(q)
+    u = np.full(N, R/N)
+    v0 = q @ u
+    target, sign = (hi, 1) if v0 > hi else (lo, -1)
+
+    def gaps_at(mu):
+        return project_simplex(u - sign*mu*q, R)
+
+    def dual_bound(mu, dl):
+        dual = 0.5*np.sum((dl - u)**2) + mu*sign*(q @ dl - target)
+        return variance_cost(max(2*dual/N, 0), N, R, alpha_value, use_theil)
+
+    def feasible(dl):
+        return sign*(q @ dl - target) <= 0
+
+    # Bracket the multiplier, starting from the one that solves the problem without dl >= 0
+    q_centred = q - np.mean(q)
+    mu_lo, dl_lo = 0.0, u
+    mu_hi = abs(v0 - target)/(q_centred @ q_centred)
+    dl_hi = gaps_at(mu_hi)
+    for _ in range(maxiter):
+        lower = max(lower, dual_bound(mu_hi, dl_hi))
+        if feasible(dl_hi):
+            break
+        if past(deadline):
+            return min(lower, upper), upper, labels
+        mu_lo, dl_lo = mu_hi, dl_hi
+        mu_hi *= 2
+        dl_hi = gaps_at(mu_hi)
+    else:
+        return min(lower, upper), upper, labels
+
+    for _ in range(maxiter):
+        # Feasible candidates: the upper end of the bracket and the point between
+        # both ends that meets the constraint exactly
+        theta = (q @ dl_hi - target)/(q @ dl_hi - q @ dl_lo)
+        for dl in (dl_hi, theta*dl_lo + (1 - theta)*dl_hi):
+            candidate = labels_from_gaps(dl, scale_min)
+            candidate_cost = cost(candidate, alpha_value, use_theil)
+            if candidate_cost < upper:
+                upper, labels = candidate_cost, candidate
+        if bounds_decided(lower, upper, gap, threshold) or mu_hi - mu_lo <= 1e-12*mu_hi or past(deadline):
+            break
+
+        mu = (mu_lo + mu_hi)/2
+        dl = gaps_at(mu)
+        lower = max(lower, dual_bound(mu, dl))
+        if feasible(dl):
+            mu_hi, dl_hi = mu, dl
+        else:
+            mu_lo, dl_lo = mu, dl
+
+    return min(lower, upper), upper, labels
+
+def anytime_task(a, lo, hi, task, constraints):
+    """anytime_minimum() for lo <= a @ l <= hi with the settings of a task; returns (cost, labels, approximate).
+
+    If the bounds of the Theil index are still undecided, minimize() is run from
+    the best labels found and from the starting labels of the task (the Theil
+    index has kinks where gaps are zero), and a result is used if it is feasible
+    and cheaper. The result is approximate if the time budget ran out first.
+    """
+    scale_min, scale_max = task["scale_min"], task["scale_max"]
+    gap, threshold = task.get("gap", 0.0), task.get("threshold")
+    deadline = task_deadline(task)
+    q, lo_q, hi_q = gap_constraint(a, lo, hi, scale_min)
+    bounds = anytime_minimum(q, lo_q, hi_q, scale_max - scale_min, scale_min, task["alpha"], task["theil"],
+                             gap, threshold, deadline)
+    if bounds is None:
+        return np.nan, np.asarray(task["l_start"], dtype=np.float64), False
+    lower, upper, labels = bounds
+    if task["theil"] and not bounds_decided(lower, upper, gap, threshold):
+        for start in (labels, task["l_start"]):
+            if past(deadline):
+                break
+            result = tracked_minimize(cost, start, (task["alpha"], task["theil"]), constraints, deadline=deadline)
+            if result.fun < upper and satisfies(constraints, result.x):
+                upper, labels = result.fun, result.x
+    return upper, labels, past(deadline) and not bounds_decided(lower, upper, gap, threshold)
+
+def is_anytime(task):
+    """Whether a task asks for anytime minimisation (a gap tolerance or a threshold)"""
+    return task.get("gap", 0.0) > 0 or task.get("threshold") is not None
+
+def screening_fallback(a, lo, hi, task):
+    """Cost and labels of the closed-form upper bound for lo <= a @ l <= hi (nan if infeasible)"""
+    q, lo_q, hi_q = gap_constraint(a, lo, hi, task["scale_min"])
+    screen = screening_bounds(q, lo_q, hi_q, task["scale_max"] - task["scale_min"], task["scale_min"],
+                              task["alpha"], task["theil"])
+    if screen is None:
+        return np.nan, np.asarray(task["l_start"], dtype=np.float64)
+    return screen[1], screen[2]
+
+#-------------------------------------
+#6.4 Time budget
+#-------------------------------------
+
+def task_deadline(task):
+    """time.monotonic() value after which a task with a budget (in seconds) stops, or None"""
+    budget = task.get("budget")
+    return time.monotonic() + budget if budget else None
+
+def past(deadline):
+    """Whether deadline (None: no deadline) has passed"""
+    return deadline is not None and time.monotonic() > deadline
+
+#-------------------------------------
+#6.5 Searches that can stop early
+#-------------------------------------
+
+class _ThresholdReached(Exception):
+    pass
+
+class _BudgetExhausted(Exception):
+    pass
+
+def satisfies(constraints, x, tol=1e-8):
+    """Whether x satisfies every LinearConstraint and NonlinearConstraint in constraints"""
+    for constraint in constraints:
+        if isinstance(constraint, LinearConstraint):
+            value = np.atleast_2d(constraint.A) @ x
+        else:
+            value = np.atleast_1d(constraint.fun(x))
+        if np.any(value < constraint.lb - tol) or np.any(value > constraint.ub + tol):
+            return False
+    return True
+
+def tracked_minimize(fun, x0, args, constraints, threshold=None, deadline=None, **kwargs):
+    """minimize() that stops at a threshold or a deadline.
+
+    Stops at the first feasible point whose cost is at most threshold. Once
+    time.monotonic() passes deadline, returns the best feasible iterate found so
+    far (fun is nan if there is none). The result has approximate=True if the
+    deadline stopped the search.
+    """
+    best = {"fun": np.nan, "x": np.asarray(x0, dtype=np.float64)}
+
+    def tracked(x, *fun_args):
+        if past(deadline):
+            raise _BudgetExhausted
+        value = fun(x, *fun_args)
+        if threshold is not None and value <= threshold and satisfies(constraints, x):
+            best.update(fun=value, x=np.array(x))
+            raise _ThresholdReached
+        return value
+
+    def keep_best(xk, *_):
+        value = fun(xk, *args)
+        if not value >= best["fun"] and satisfies(constraints, xk):
+            best.update(fun=value, x=np.array(xk))
+
+    try:
+        result = minimize(tracked, x0, args=args, constraints=constraints,
+                          callback=keep_best if deadline is not None else None, **kwargs)
+        result.approximate = False
+        return result
+    except _ThresholdReached:
+        return OptimizeResult(fun=best["fun"], x=best["x"], success=True, status=0, approximate=False,
+                              message="Cost below threshold")
+    except _BudgetExhausted:
+        return OptimizeResult(fun=best["fun"], x=best["x"], success=not np.isnan(best["fun"]), status=9,
+                              approximate=True, message="Time budget exhausted")
+
+#=====================================
+#7. Cost minimisation
+#=====================================
+
+# Every solver returns (cost, labels, approximate), where approximate is True
+# if the time budget of the task ran out before the search finished.
+
+#-------------------------------------
+#7.1 Sign reversal (as in sign_reversal_cost_minimizer.py)
+#-------------------------------------
+
+def sign_reversal_task(task):
+    """Minimum cost for the coefficient implied by bd to cross revpoint"""
+    bd, sign, revpoint = task["bd"], task["sign"], task["revpoint"]
+    l_start = np.asarray(task["l_start"], dtype=np.float64)
+    nlabs = len(l_start)
+    monotonicity_constraint, boundary_constraint = label_constraints(nlabs, task["scale_min"], task["scale_max"])
+    lo, hi = (-np.inf, revpoint) if sign > 0 else (revpoint, np.inf)
+    reversal_constraint = LinearConstraint(reversal_array(bd), lo, hi)
+    constraints = [monotonicity_constraint, reversal_constraint, boundary_constraint]
+    if is_anytime(task):
+        return anytime_task(reversal_array(bd), lo, hi, task, constraints)
+    result = tracked_minimize(cost, l_start, (task["alpha"], task["theil"]), constraints,
+                              deadline=task_deadline(task))
+    if np.isnan(result.fun):
+        # Out of time before any feasible labels: fall back to the closed-form upper bound
+        return (*screening_fallback(reversal_array(bd), lo, hi, task), True)
+    return result.fun, result.x, result.approximate
+
+#-------------------------------------
+#7.2 Reaching a target p-value (as in p_value_cost_minimizer.py)
+#-------------------------------------
+
+def pvalue_task(task):
+    """Minimum cost for the p-value of coefficient idx to cross target_p.
+
+    decrease gives the direction: True if the p-value at the original labels
+    is above target_p. It is not taken from l_start, which may be a previous
+    optimum on the boundary (state() updates).
+    """
+    stats, idx, target_p = task["stats"], task["idx"], task["target_p"]
+    l_start = np.asarray(task["l_start"], dtype=np.float64)
+    nlabs = len(l_start)
+    monotonicity_constraint, boundary_constraint = label_constraints(nlabs, task["scale_min"], task["scale_max"])
+
+    def p_constraint(labels_transformed):
+        return pvalues_from_gaps(stats, label_gaps(labels_transformed))[idx]
+
+    if task["decrease"]:
+        p_nonlinear = NonlinearConstraint(p_constraint, -np.inf, target_p, jac='2-point', hess=BFGS())
+    else:
+        p_nonlinear = NonlinearConstraint(p_constraint, target_p, np.inf, jac='2-point', hess=BFGS())
+    constraints = [monotonicity_constraint, p_nonlinear, boundary_constraint]
+    # There is no cheap lower bound for p-values, so only a threshold can stop the search early
+    result = tracked_minimize(cost, l_start, (task["alpha"], task["theil"]), constraints,
+                              threshold=task.get("threshold"), deadline=task_deadline(task),
+                              tol=1e-8, options={'maxiter': 10000, 'disp': False})
+    return result.fun, result.x, result.approximate
+
+#-------------------------------------
+#7.3 Reaching a target coefficient ratio (as in mrs_reverser_python.py)
+#-------------------------------------
+
+def mrs_task(task):
+    """Minimum cost for the ratio of the coefficients implied by bdm and bdn to equal target"""
+    am, an, target = reversal_array(task["bdm"]), reversal_array(task["bdn"]), task["target"]
+    l_start = np.asarray(task["l_start"], dtype=np.float64)
+    nlabs = len(l_start)
+    monotonicity_constraint, boundary_constraint = label_constraints(nlabs, task["scale_min"], task["scale_max"])
+    target_constraint = NonlinearConstraint(lambda x: (am @ x)/(an @ x) - target, 0, 0, jac='2-point', hess=BFGS())
+    constraints = [monotonicity_constraint, target_constraint, boundary_constraint]
+    # am @ l = target * an @ l is linear in the labels
+    if is_anytime(task):
+        fun, labels, approximate = anytime_task(am - target*an, 0.0, 0.0, task, constraints)
+    else:
+        try:
+            result = tracked_minimize(cost, l_start, (task["alpha"], task["theil"]), constraints,
+                                      deadline=task_deadline(task), tol=1e-8, options={'maxiter': 10000, 'disp': False})
+        except Exception:
+            return np.nan, l_start, False
+        if not result.success and not result.approximate:
+            return np.nan, result.x, False
+        fun, labels, approximate = result.fun, result.x, result.approximate
+        if np.isnan(fun):
+            # Out of time before any feasible labels: fall back to the closed-form upper bound
+            fun, labels = screening_fallback(am - target*an, 0.0, 0.0, task)
+    if np.isnan(fun) or abs(an @ labels) < 1e-12:
+        return np.nan, labels, approximate
+    return fun, labels, approximate
+
+#=====================================
+#8. Run many cost minimisations
+#=====================================
+
+SOLVERS = {"sign": sign_reversal_task, "pvalue": pvalue_task, "mrs": mrs_task}
+
+def solve_task(task):
+    """Run one (kind, arguments) task with the solver for its kind"""
+    kind, args = task
+    return SOLVERS[kind](args)
+
+def run_parallel(func, tasks, workers=1):
+    """Apply func to every task, in a pool of worker processes if workers > 1.
+
+    workers=0 uses all available CPUs. Worker processes are forked from the
+    running (Stata) process, which is only done on Linux; elsewhere the
+    tasks are run one after the other. Forking a multithreaded process such
+    as Stata is not guaranteed to be safe, so the Stata commands only ask
+    for workers if workers() is set. If the run is interrupted (Break in
+    Stata), the results of the tasks that have finished are returned and the
+    others are None.
+    """
+    results = [None]*len(tasks)
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(tasks))
+    if workers > 1 and sys.platform.startswith("linux"):
+        context = multiprocessing.get_context("fork")
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        futures = [pool.submit(func, task) for task in tasks]
+        try:
+            for i, future in enumerate(futures):
+                results[i] = future.result()
+        except KeyboardInterrupt:
+            for i, future in enumerate(futures):
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    results[i] = future.result()
+            pool.shutdown(wait=False, cancel_futures=True)
+        else:
+            pool.shutdown()
+        return results
+    try:
+        for i, task in enumerate(tasks):
+            results[i] = func(task)
+    except KeyboardInterrupt:
+        pass
+    return results
+
+#=====================================
+#9. Multi-start minimisation
+#=====================================
+
+# The Theil index has kinks wherever a gap is zero, so a local solve depends on
+# where it starts. For constraints that are linear in the labels, candidate
+# starts are spread over the simplex of gaps, moved onto the constraint and
+# screened by their cost; the cheapest are then solved locally in parallel.
+
+#-------------------------------------
+#9.1 Candidate starting labels
+#-------------------------------------
+
+def batch_cost(L, alpha_value, use_theil):
+    """cost() of every row of L at once"""
+    L = np.asarray(L, dtype=np.float64)
+    dl = np.diff(L, axis=1)
+    maxdl = L[:, -1] - L[:, 0]
+    N = L.shape[1] - 1
+    exponent = 1/alpha_value
+
+    if use_theil:
+        ratio = dl / maxdl[:, np.newaxis] * N
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = np.where(ratio > 0, ratio*np.log(ratio), 0)
+        theil = np.maximum(np.sum(terms, axis=1) / N, 0)
+        return (theil / np.log(N))**exponent
+
+    maxvar = (1/N - 1/N**2)*maxdl**2
+    var = np.mean((dl - maxdl[:, np.newaxis]/N)**2, axis=1)
+    return (var/maxvar)**exponent
+
+def linear_reversal(kind, args):
+    """(a, lo, hi) such that a task asks for lo <= a @ l <= hi, or None if its constraint is not linear"""
+    if kind == "sign":
+        lo, hi = (-np.inf, args["revpoint"]) if args["sign"] > 0 else (args["revpoint"], np.inf)
+        return reversal_array(args["bd"]), lo, hi
+    if kind == "mrs":
+        return reversal_array(args["bdm"]) - args["target"]*reversal_array(args["bdn"]), 0.0, 0.0
+    return None
+
+def candidate_starts(a, lo, hi, nlabs, scale_min, scale_max, alpha_value, use_theil, n_starts, seed=0):
+    """Up to n_starts labels that satisfy lo <= a @ l <= hi, cheapest first, and their costs.
+
+    The gaps of the candidates are a seeded Latin hypercube sample mapped
+    uniformly onto the simplex, and the single-gap labels (the hd
+    transformations). Every candidate is mixed with the single-gap labels
+    that meet the constraint at the smallest weight, as in screening_bounds().
+    """
+    R = scale_max - scale_min
+    N = nlabs - 1
+    q, lo_q, hi_q = gap_constraint(a, lo, hi, scale_min)
+
+    # Normalised exponential spacings of uniform draws are uniform on the simplex
+    u = qmc.LatinHypercube(d=N, seed=seed).random(max(8*n_starts, 64))
+    gaps = -np.log1p(-u)
+    gaps = gaps/gaps.sum(axis=1, keepdims=True)*R
+    vertices = np.eye(N)*R
+    gaps = np.vstack([gaps, vertices])
+
+    value = gaps @ q
+    shortfall = np.clip(value, lo_q, hi_q) - value
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = shortfall[:, np.newaxis]/(R*q[np.newaxis, :] - value[:, np.newaxis])
+    weight[~np.isfinite(weight) | (weight < 0) | (weight > 1)] = np.inf
+    weight[shortfall == 0] = 0
+    j = np.argmin(weight, axis=1)
+    w = weight[np.arange(len(gaps)), j]
+    feasible = np.isfinite(w)
+    w, j = w[feasible, np.newaxis], j[feasible]
+    gaps = (1 - w)*gaps[feasible] + w*vertices[j]
+
+    labels = scale_min + np.hstack([np.zeros((len(gaps), 1)), np.cumsum(gaps, axis=1)])
+    labels[:, -1] = scale_max
+    labels = np.unique(np.round(labels, 12), axis=0)
+    costs = batch_cost(labels, alpha_value, use_theil)
+    order = np.argsort(costs, kind='stable')[:n_starts]
+    return labels[order], costs[order]
+
+#-------------------------------------
+#9.2 Solving from several starts
+#-------------------------------------
+
+def multistart(tasks, n_starts, workers=1, seed=0):
+    """run_parallel(solve_task, tasks, workers), solving Theil tasks from n_starts starts.
+
+    A Theil task whose constraint is linear in the labels is solved from its
+    own l_start and from the n_starts-1 cheapest candidate_starts(), all in one
+    parallel run. Its result is the cheapest that satisfies the constraints;
+    the cheapest candidate itself also counts. Returns the results and, for
+    every task, the spread of the costs across starts (the most minus the
+    least costly feasible result; nan for tasks solved from one start).
+    """
+    expanded = []
+    plans = []          # (first expanded task, number of starts, constraints, cheapest candidate)
+    for kind, args in tasks:
+        linear = linear_reversal(kind, args) if args["theil"] and n_starts > 1 else None
+        starts = [args["l_start"]]
+        constraints = candidate = None
+        if linear is not None:
+            nlabs = len(args["l_start"])
+            labels, costs = candidate_starts(*linear, nlabs, args["scale_min"], args["scale_max"],
+                                             args["alpha"], args["theil"], n_starts-1, seed)
+            starts += list(labels)
+            constraints = [*label_constraints(nlabs, args["scale_min"], args["scale_max"]), LinearConstraint(*linear)]
+            # A ratio is undefined if its denominator is zero, as in mrs_task()
+            if len(labels) and (kind != "mrs" or abs(reversal_array(args["bdn"]) @ labels[0]) >= 1e-12):
+                candidate = (costs[0], labels[0], False)
+        plans.append((len(expanded), len(starts), constraints, candidate))
+        expanded += [(kind, dict(args, l_start=start)) for start in starts]
+
+    solved = run_parallel(solve_task, expanded, workers)
+
+    results = [None]*len(tasks)
+    spread = np.full(len(tasks), np.nan)
+    for i, (first, count, constraints, candidate) in enumerate(plans):
+        finished = [result for result in solved[first:first+count] if result is not None]
+        if constraints is None:
+            results[i] = finished[0] if finished else None
+            continue
+        if not finished:
+            continue
+        feasible = [result for result in finished
+                    if not np.isnan(result[0]) and satisfies(constraints, result[1], 1e-7)]
+        approximate = any(result[2] for result in finished)
+        if feasible:
+            costs = [result[0] for result in feasible]
+            spread[i] = max(costs) - min(costs)
+        if candidate is not None:
+            feasible.append(candidate)
+        if feasible:
+            best = min(feasible, key=lambda result: result[0])
+            results[i] = (best[0], best[1], approximate)
+        else:
+            results[i] = finished[0]
+    return results, spread
+
+#=====================================
+#10. Tasks of the by(), outcomes(), state() and rank() routines
+#=====================================
+
+#-------------------------------------
+#10.1 Settings
+#-------------------------------------
+
+def read_settings():
+    """Settings of the cost minimisations from the Stata locals, as (settings, workers, starts).
+
+    settings holds the entries every task takes: alpha, theil, gap, threshold
+    (None if negative) and budget in seconds per cost minimisation (None if 0).
+    starts is the number of starting labels for each Theil cost minimisation.
+    """
+    threshold = float(Macro.getLocal('threshold'))
+    settings = {"alpha": float(Macro.getLocal('alpha')),
+                "theil": Macro.getLocal('theil') != '',
+                "gap": float(Macro.getLocal('gap')),
+                "threshold": threshold if threshold >= 0 else None,
+                "budget": float(Macro.getLocal('budget')) or None}
+    return settings, int(Macro.getLocal('workers')), int(Macro.getLocal('starts'))
+
+#-------------------------------------
+#10.2 Coefficients of all of e(b)
+#-------------------------------------
+
+def expand_stats(stats, x_cols, k_all):
+    """stats with B and kept for all k_all columns of e(b). Columns not in x_cols (omitted) stay at zero and are not kept."""
+    bds = np.zeros((k_all, stats["B"].shape[1]))
+    bds[x_cols] = stats["B"]
+    kept = np.zeros(k_all, dtype=bool)
+    kept[x_cols] = stats["kept"]
+    return dict(stats, B=bds, kept=kept)
+
+#-------------------------------------
+#10.3 Sign and p-value reversals (coeff_reverser)
+#-------------------------------------
+
+def coefficient_tasks(stats, explanatory, levels, scale_min, scale_max, revpoint, settings, target_p=None,
+                      labels_start=None, labels_start_p=None):
+    """Coefficients, their bounds and the tasks that reverse them, for the columns in explanatory.
+
+    stats is from expand_stats(). Returns a dict of arrays with one entry per
+    column in explanatory (b, minb, maxb and, unless target_p is None, p, minp
+    and maxp; nan for columns that are not kept) and a list of (position in
+    explanatory, kind, arguments) tasks. labels_start and labels_start_p may
+    give starting labels for every column of e(b), e.g. the previously optimal
+    ones; columns without them start from levels.
+    """
+    bds, kept = stats["B"], stats["kept"]
+    b = bds @ label_gaps(levels)
+    keys = ["b", "minb", "maxb"] + (["p", "minp", "maxp"] if target_p is not None else [])
+    out = {key: np.full(len(explanatory), np.nan) for key in keys}
+    if target_p is not None:
+        p_orig = pvalues_from_gaps(stats, label_gaps(levels))
+        p_hd = hd_pvalues(stats)
+
+    def start(stored, col):
+        return levels if stored is None or np.isnan(stored[col]).any() else stored[col]
+
+    tasks = []
+    for j, col in enumerate(explanatory):
+        if not kept[col]:
+            continue
+        bd = bds[col]
+        out["b"][j] = b[col]
+        out["minb"][j] = -np.max(bd)*(scale_max - scale_min)
+        out["maxb"][j] = -np.min(bd)*(scale_max - scale_min)
+
+        if is_reversible(bd, revpoint, scale_min, scale_max):
+            tasks.append((j, "sign", dict(settings, bd=bd, sign=np.sign(b[col]), revpoint=revpoint,
+                                          l_start=start(labels_start, col), scale_min=scale_min, scale_max=scale_max)))
+
+        if target_p is not None:
+            out["p"][j] = p_orig[col]
+            out["minp"][j] = np.min(p_hd[:, col])
+            out["maxp"][j] = 1 if is_reversible(bd, 0, scale_min, scale_max) else np.max(p_hd[:, col])
+            if out["minp"][j] <= target_p <= out["maxp"][j]:
+                tasks.append((j, "pvalue", dict(settings, stats=stats, idx=col, target_p=target_p,
+                                                decrease=p_orig[col] > target_p, l_start=start(labels_start_p, col),
+                                                scale_min=scale_min, scale_max=scale_max)))
+    return out, tasks
+
+#-------------------------------------
+#10.4 Ratios relative to the denominator (mrs_reverser)
+#-------------------------------------
+
+def ratio_tasks(stats, denom, numerators, target, settings, rng):
+    """Ratios of the numerators to the denominator, their bounds and the tasks that reach target.
+
+    stats is from expand_stats(). The ratios are those at the labels 1, ..., K,
+    as in mrs_reverser. Returns a dict of arrays with one entry per column in
+    numerators (ratio, minratio and maxratio; the bounds are infinite if the
+    sign of the denominator can be reversed, nan for columns that are not
+    kept) and a list of (position in numerators, "mrs", arguments) tasks, none
+    if target is None. The tasks start from sorted uniform labels drawn from
+    rng, so a seeded rng gives the same starts in every run.
+    """
+    bds, kept = stats["B"], stats["kept"]
+    nlabs = bds.shape[1] + 1
+    l_mrs = np.arange(1, nlabs+1, dtype=np.float64)
+    out = {key: np.full(len(numerators), np.nan) for key in ("ratio", "minratio", "maxratio")}
+    tasks = []
+    if not kept[denom]:
+        return out, tasks
+
+    bdn = bds[denom]
+    denom_reversible = 0 < np.sum(bdn > 0) < nlabs-1
+    for j, col in enumerate(numerators):
+        if not kept[col]:
+            continue
+        bdm = bds[col]
+        out["ratio"][j] = (bdm @ label_gaps(l_mrs)) / (bdn @ label_gaps(l_mrs))
+        if denom_reversible:
+            out["minratio"][j], out["maxratio"][j] = -np.inf, np.inf
+        else:
+            out["minratio"][j], out["maxratio"][j] = np.min(bdm/bdn), np.max(bdm/bdn)
+        if target is not None and (denom_reversible or out["minratio"][j] <= target <= out["maxratio"][j]):
+            l_initial = np.sort(rng.uniform(low=l_mrs[0], high=l_mrs[-1], size=nlabs))
+            l_initial[0], l_initial[-1] = l_mrs[0], l_mrs[-1]
+            tasks.append((j, "mrs", dict(settings, bdm=bdm, bdn=bdn, target=target,
+                                         l_start=l_initial, scale_min=l_mrs[0], scale_max=l_mrs[-1])))
+    return out, tasks
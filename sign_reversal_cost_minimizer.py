@@ -185,11 +185,40 @@ boundary_constraint = LinearConstraint([tmp1,tmp2], [scale_min,scale_max], [scal
 #1.6 Minimize cost function subject to the constraints
 #-------------------------------------
 
-#Minimize cost function and save result
-result = minimize(cost, l_transformed, constraints=[monotonicity_constraint, reversal_constraint, boundary_constraint])
+#Anytime settings: stop once the cost is known to within gap() or relative to threshold(), or after budget() seconds
+gap = float(Macro.getLocal('gap'))
+threshold = float(Macro.getLocal('threshold'))
+budget = float(Macro.getLocal('budget'))
+
+#Multi-start settings: the Theil index is minimised from starts() starting labels, solved in parallel
+starts = int(Macro.getLocal('starts'))
+multistart_theil = use_theil and starts > 1
+spread = np.nan
+
+if gap > 0 or threshold >= 0 or budget > 0 or multistart_theil:
+	#Bounds, anytime minimisation, time budget and multi-start from the shared routines
+	import sys
+	sys.path.insert(0, Macro.getLocal('pydir'))
+	from reversals_core import sign_reversal_task, multistart
+	task = {"bd": np.asarray(bd[0:nlabs-1]), "sign": sign, "revpoint": reversal_point,
+	        "l_start": l_transformed, "scale_min": scale_min, "scale_max": scale_max,
+	        "alpha": alpha_value, "theil": use_theil, "gap": gap,
+	        "threshold": threshold if threshold >= 0 else None,
+	        "budget": budget if budget > 0 else None}
+	if multistart_theil:
+		results, spreads = multistart([("sign", task)], starts, int(Macro.getLocal('workers')))
+		if results[0] is None:
+			raise KeyboardInterrupt
+		(cost_min, labels_min, approximate), spread = results[0], spreads[0]
+	else:
+		cost_min, labels_min, approximate = sign_reversal_task(task)
+else:
+	#Minimize cost function and save result
+	result = minimize(cost, l_transformed, constraints=[monotonicity_constraint, reversal_constraint, boundary_constraint])
+	cost_min, labels_min, approximate = result.fun, result.x, False
 
 #Save cost value
-cost_value = [result.fun]*nlabs # just puts things into the right format 			
+cost_value = [cost_min]*nlabs # just puts things into the right format 			
 
 #-------------------------------------
 #1.7 Output result to Stata
@@ -197,6 +226,10 @@ cost_value = [result.fun]*nlabs # just puts things into the right format
 
 Data.addVarDouble("python_labels")
 Data.addVarDouble("python_cost")
+Data.addVarDouble("python_approx")
+Data.addVarDouble("python_spread")
 
-Data.store("python_labels", None, result.x, None)
-Data.store("python_cost", None, cost_value, None)
\ No newline at end of file
+Data.store("python_labels", None, labels_min, None)
+Data.store("python_cost", None, cost_value, None)
+Data.store("python_approx", None, [float(approximate)]*nlabs, None)
+Data.store("python_spread", None, [spread]*nlabs, None)
\ No newline at end of file